@@ -1,15 +1,17 @@
-import datetime
-import queue
-import threading
-import time
-from typing import Optional
+import asyncio
+import contextlib
+import logging
+from typing import Optional, Union
 
-import urllib3
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+import aiohttp
+from influxdb_client import WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
 
 from sqm.sqm import Report
 
+# put in queue on stop, so that writer wakes up, sends everything before it and finishes
+_SENTINEL = object()
+
 
 class Influx:
     def __init__(
@@ -18,61 +20,112 @@ class Influx:
         token: Optional[str] = None,
         org: Optional[str] = None,
         bucket: Optional[str] = None,
+        batch_size: int = 100,
+        max_queue_size: int = 10_000,
     ):
-        # init db connection
-        self._client: Optional[InfluxDBClient] = None
-        self._bucket: Optional[str] = None
-        if url is not None and token is not None and org is not None and bucket is not None:
-            self._client = InfluxDBClient(url=url, token=token, org=org)
-            self._bucket = bucket
+        # db connection
+        self._url = url
+        self._token = token
+        self._org = org
+        self._bucket = bucket
+        self._enabled = url is not None and token is not None and org is not None and bucket is not None
 
         # init queue
-        self._queue = queue.Queue()
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_queue_size)
+        self._batch_size = batch_size
 
-        # thread
-        self._closing = threading.Event()
-        self._thread = threading.Thread(target=self._send_measurements)
+        # writer task
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = asyncio.Event()
 
     def start(self):
-        """Start thread."""
-        self._thread.start()
+        """Start writer task on the running event loop."""
+        if self._enabled:
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self._send_measurements())
 
-    def stop(self):
-        """End thread."""
-        self._closing.set()
-        self._thread.join()
+    async def stop(self):
+        """Send remaining measurements and end writer task."""
+        if self._task is not None:
+            self._loop = None
+            self._closing.set()
+            self._put(_SENTINEL)
+            await self._task
 
     def __call__(self, report: Report):
-        """Put a new measurement in the send queue."""
-        if self._client is not None:
-            self._queue.put(report)
+        """Put a new measurement in the send queue. Thread-safe.
 
-    def _send_measurements(self):
-        """Run until closing to send reports."""
+        The queue is bounded, so if the database is unreachable for a long time, the oldest measurements get
+        dropped. This keeps memory usage flat and makes sure that recent data is sent first after recovery.
+        """
+        if self._loop is not None:
+            # schema is fixed, so build line protocol directly
+            line = f"sqm skymag={report.values['sky_brightness']} {int(report.time.timestamp())}"
+            self._loop.call_soon_threadsafe(self._put, line)
 
-        # no client?
-        if self._client is None:
-            return
+    def _put(self, line: Union[str, object]):
+        """Put line in queue, drop oldest one if full."""
+        try:
+            self._queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self._queue.get_nowait()
+            self._queue.put_nowait(line)
 
-        # get API
-        write_api = self._client.write_api(SYNCHRONOUS)
+    async def _next_batch(self) -> list[str]:
+        """Wait for a line and drain all pending ones into a batch."""
 
-        # run (almost) forever
-        while not self._closing.is_set():
-            # get next values to send
-            report = self._queue.get()
+        # wait for first line
+        line = await self._queue.get()
 
-            # send it
+        # drain queue until empty, batch is full or sentinel is reached
+        batch = []
+        while line is not _SENTINEL:
+            batch.append(line)
+            if len(batch) >= self._batch_size:
+                break
             try:
-                write_api.write(
-                    bucket=self._bucket,
-                    record={
-                        "measurement": "sqm",
-                        "fields": {"skymag": report.values["sky_brightness"]},
-                        "time": report.time.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    },
-                )
-            except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ReadTimeoutError):
-                # put message back and wait a little
-                self._queue.put(report)
-                time.sleep(10)
+                line = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _send_measurements(self):
+        """Run until closing and queue is empty to send reports."""
+
+        # single client with keep-alive connection pool for all writes, line protocol compresses well
+        async with InfluxDBClientAsync(
+            url=self._url, token=self._token, org=self._org, enable_gzip=True, timeout=30_000
+        ) as client:
+            # get API
+            write_api = client.write_api()
+
+            # run (almost) forever
+            batch: list[str] = []
+            while True:
+                # get next points to send, unless we still have a failed batch
+                if len(batch) == 0:
+                    # everything sent and closing?
+                    if self._closing.is_set() and self._queue.empty():
+                        break
+                    batch = await self._next_batch()
+                    if len(batch) == 0:
+                        continue
+
+                # send them in a single request
+                try:
+                    await write_api.write(bucket=self._bucket, record=batch, write_precision=WritePrecision.S)
+                    batch = []
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    # no retries on shutdown
+                    if self._closing.is_set():
+                        logging.warning("Could not send remaining measurements to InfluxDB on shutdown.")
+                        break
+
+                    # keep batch for next try and wait a little
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._closing.wait(), 10)
+                except Exception:
+                    # drop batch, it won't get any better
+                    logging.exception("Could not write measurements to InfluxDB")
+                    batch = []
@@ -3,25 +3,32 @@ import logging
 import threading
 import time
 from typing import Optional
-from astropy.coordinates import EarthLocation, get_sun, AltAz
-import astropy.units as u
+import numpy as np
 import serial
-from astropy.time import Time
+
+# serial commands
+_CMD_META = b"ix"
+_CMD_CAL = b"cx"
+_CMD_DATA = b"rx"
+
+
+# columns in a report
+COLUMNS = ["temp_sensor", "freq_sensor", "ticks_uC", "sky_brightness"]
 
 
 class Report:
-    def __init__(self, values: Optional[dict[str, float]] = None, dt: Optional[datetime.datetime] = None):
-        self.values = (
-            values
-            if values is not None
-            else {
-                "temp_sensor": 0,
-                "freq_sensor": 0,
-                "ticks_uC": 0,
-                "sky_brightness": 0,
-            }
-        )
-        self.time = dt if dt is not None else datetime.datetime.utcnow()
+    """A single measurement, values are stored in an array in the order given by COLUMNS."""
+
+    __slots__ = ("arr", "time")
+
+    def __init__(self, arr: Optional[np.ndarray] = None, dt: Optional[datetime.datetime] = None):
+        self.arr = arr if arr is not None else np.zeros(len(COLUMNS))
+        self.time = dt if dt is not None else datetime.datetime.now(datetime.timezone.utc)
+
+    @property
+    def values(self) -> dict[str, float]:
+        """Values as dictionary."""
+        return dict(zip(COLUMNS, self.arr.tolist()))
 
 
 class UnihedronSQM:
@@ -39,6 +46,7 @@ class UnihedronSQM:
         interval: int = 10,
         location: Optional[tuple[float, float, float]] = None,
         max_sun_alt: float = 10.0,
+        sun_check_interval: float = 60.0,
         *args,
         **kwargs,
     ):
@@ -51,6 +59,7 @@ class UnihedronSQM:
             parity: Parity.
             stopbits: Stop bits.
             rtscts: RTSCTS.
+            sun_check_interval: Interval in secs between re-computations of the sun's altitude.
             *args:
             **kwargs:
         """
@@ -68,19 +77,28 @@ class UnihedronSQM:
         # stuff
         self.interval = interval
 
-        # location
-        self.location = (
-            None
-            if location is None
-            else EarthLocation(lon=location[0] * u.deg, lat=location[1] * u.deg, height=location[2] * u.m)
-        )
+        # location, astropy is slow to import, so only do so if we need it
+        self.location = None
+        if location is not None:
+            from astropy.coordinates import EarthLocation, get_sun, AltAz
+            import astropy.units as u
+            from astropy.time import Time
+
+            self.location = EarthLocation(lon=location[0] * u.deg, lat=location[1] * u.deg, height=location[2] * u.m)
+            self._astropy = (get_sun, AltAz, Time)
         self.max_sun_alt = max_sun_alt
 
+        # cached sun altitude, updated at most every sun_check_interval seconds
+        self.sun_check_interval = sun_check_interval
+        self._last_sun_check = 0.0
+        self._last_sun_alt: Optional[float] = None
+
         # poll thread
         self._closing = None
         self._thread = None
         self._thread_sleep = 1
         self._max_thread_sleep = 900
+        self._max_read_errors = 3
 
         # callback function
         self._callback = None
@@ -117,6 +135,7 @@ class UnihedronSQM:
 
         # init
         self._serial_errors = 0
+        self._read_errors = 0
         self._sleep_time = self._thread_sleep
 
         # loop until closing
@@ -126,20 +145,26 @@ class UnihedronSQM:
             except:
                 # sleep a little and continue
                 logging.exception("Somethingw went wrong")
-                time.sleep(10)
+                self._closing.wait(10)
 
         # close connection
-        self._conn.close()
+        if self._conn is not None:
+            self._conn.close()
 
     def _poll(self):
         # what about the sun?
         if self.location is not None:
-            # get sun location
-            sun = get_sun(Time.now()).transform_to(AltAz(location=self.location, obstime=Time.now()))
+            # update sun location, if outdated
+            now = time.monotonic()
+            if self._last_sun_alt is None or now - self._last_sun_check > self.sun_check_interval:
+                get_sun, AltAz, Time = self._astropy
+                t = Time.now()
+                self._last_sun_alt = get_sun(t).transform_to(AltAz(location=self.location, obstime=t)).alt.degree
+                self._last_sun_check = now
 
             # check it
-            if sun.alt.degree > self.max_sun_alt:
-                time.sleep(30)
+            if self._last_sun_alt > self.max_sun_alt:
+                self._closing.wait(30)
                 return
 
         # get serial connection
@@ -154,6 +179,11 @@ class UnihedronSQM:
                 self._sleep_time = self._thread_sleep
 
             except serial.SerialException as e:
+                # close broken connection
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+
                 # if no connection, log less often
                 self._serial_errors += 1
                 if self._serial_errors % 10 == 0:
@@ -172,10 +202,20 @@ class UnihedronSQM:
         if self._conn is not None:
             # read and analyse data
             data = self.read_data()
-            self._callback(Report(data))
+            if data is not None:
+                self._read_errors = 0
+                self._callback(Report(np.array([data[c] for c in COLUMNS])))
+            elif not self._closing.is_set():
+                # too many failed reads? then reconnect in next poll
+                self._read_errors += 1
+                if self._read_errors >= self._max_read_errors:
+                    logging.warning("%d failed reads from SQM, reconnecting", self._read_errors)
+                    self._conn.close()
+                    self._conn = None
+                    self._read_errors = 0
 
         # sleep
-        time.sleep(self.interval)
+        self._closing.wait(self.interval)
 
     def _connect_serial(self):
         """Open/reset serial connection to sensor."""
@@ -199,12 +239,17 @@ class UnihedronSQM:
         if not self._conn.is_open:
             self._conn.open()
 
-        # initial calls
-        time.sleep(1)
-        self.read_metadata(tries=10)
-        time.sleep(1)
-        self.cx_readout = self.read_calibration(tries=10)
-        time.sleep(1)
+        # initial calls, abort if closing
+        if self._closing.wait(1):
+            return
+        if not self.read_metadata(tries=10):
+            raise serial.SerialException("No valid metadata from SQM.")
+        if self._closing.wait(1):
+            return
+        if not self.read_calibration(tries=10):
+            raise serial.SerialException("No valid calibration from SQM.")
+        if self._closing.wait(1):
+            return
         self.rx_readout = self.read_data(tries=10)
 
     def read_buffer(self) -> Optional[str]:
@@ -225,18 +270,19 @@ class UnihedronSQM:
             f"Protocol: {protocol_number}, Model: {model_number}, Feature: {feature_number}, Serial: {serial_number}"
         )
 
-    def read_metadata(self, tries: int = 1):
+    def read_metadata(self, tries: int = 3) -> bool:
         """Read the serial number, firmware version"""
-        self._conn.write("ix".encode())
-        time.sleep(1)
-        msg = self.read_buffer()
-
-        # sanity check
-        if "i" in msg:
-            self.process_metadata(msg)
-        elif tries > 0:
-            self._connect_serial()
-            self.read_metadata(tries - 1)
+        for _ in range(tries):
+            self._conn.write(_CMD_META)
+            if self._closing.wait(1):
+                return False
+            msg = self.read_buffer()
+
+            # sanity check
+            if msg and "i" in msg:
+                self.process_metadata(msg)
+                return True
+        return False
 
     def process_calibration(self, msg: str, sep: str = ","):
         # get calibration
@@ -255,18 +301,19 @@ class UnihedronSQM:
         logging.info(f"  - Calibration offset: {calib_offset} mag")
         logging.info(f"  - Dark calibration temperature: {dark_calib_temp} C")
 
-    def read_calibration(self, tries=1):
+    def read_calibration(self, tries: int = 3) -> bool:
         """Read the calibration data"""
-        self._conn.write("cx".encode())
-        time.sleep(1)
-        msg = self.read_buffer()
-
-        # Check caldata
-        if "c" in msg:
-            self.process_calibration(msg)
-        elif tries > 0:
-            self._connect_serial()
-            self.read_calibration(tries - 1)
+        for _ in range(tries):
+            self._conn.write(_CMD_CAL)
+            if self._closing.wait(1):
+                return False
+            msg = self.read_buffer()
+
+            # Check caldata
+            if msg and "c" in msg:
+                self.process_calibration(msg)
+                return True
+        return False
 
     def process_data(self, msg, sep=","):
         # Get the measures
@@ -287,20 +334,18 @@ class UnihedronSQM:
             "sky_brightness": sky_brightness,
         }
 
-    def read_data(self, tries=1):
+    def read_data(self, tries: int = 3) -> Optional[dict[str, float]]:
         """Read the SQM and format the Temperature, Frequency and NSB measures"""
-        self._conn.write("rx".encode())
-        time.sleep(1)
-        msg = self.read_buffer()
-
-        # Check data
-        if "r" in msg:
-            return self.process_data(msg)
-        elif tries > 0:
-            self._connect_serial()
-            return self.read_data(tries - 1)
-        else:
-            return None
+        for _ in range(tries):
+            self._conn.write(_CMD_DATA)
+            if self._closing.wait(1):
+                return None
+            msg = self.read_buffer()
+
+            # Check data
+            if msg and "r" in msg:
+                return self.process_data(msg)
+        return None
 
 
-__all__ = ["UnihedronSQM"]
+__all__ = ["UnihedronSQM", "Report", "COLUMNS"]
@@ -1,26 +1,42 @@
 import argparse
+import atexit
+import csv
 import datetime
-import json
+import functools
+import hashlib
 import os
-from typing import Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TextIO
 import tornado.ioloop
 import tornado.web
-import tornado.httpserver
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
 import logging
 import numpy as np
+import orjson
 
 from sqm.influx import Influx
-from sqm.sqm import UnihedronSQM, Report
+from sqm.sqm import UnihedronSQM, Report, COLUMNS
 
-COLUMNS = ["temp_sensor", "freq_sensor", "ticks_uC", "sky_brightness"]
+BASE_DIR = os.path.dirname(__file__)
+STATIC_DIR = os.path.join(BASE_DIR, "static_html/")
+HEADER = f"time,{','.join(COLUMNS)}\n"
+ROW_FORMAT = "{}," + ",".join(["{:.2f}"] * len(COLUMNS)) + "\n"
+
+
+def _parse_time(s: str) -> datetime.datetime:
+    """Parse UTC time in format YYYY-MM-DDTHH:MM:SS as written to log file."""
+    return datetime.datetime.fromisoformat(s).replace(tzinfo=datetime.timezone.utc)
+
+
+def _report_json(report: Report) -> bytes:
+    """Serialize report to JSON."""
+    return orjson.dumps({"time": report.time.strftime("%Y-%m-%dT%H:%M:%S"), **report.values})
 
 
 class MainHandler(tornado.web.RequestHandler):
     def get(self):
         app: Application = self.application
-        self.render(os.path.join(os.path.dirname(__file__), "template.html"), current=app.current, history=app.history)
+        self.render("template.html", current=app.current, history=app.history_rows)
 
 
 class JsonHandler(tornado.web.RequestHandler):
@@ -37,17 +53,18 @@ class JsonHandler(tornado.web.RequestHandler):
             JSON output.
         """
 
-        # get record
+        # send to client, average only changes in sched_callback, so it's serialized and tagged there
         if which == "current":
-            report = self.application.current
+            self.write(_report_json(self.application.current))
         elif which == "average":
-            report = self.application.average
+            self.set_header("Etag", self.application.average_etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            self.write(self.application.average_json)
         else:
             raise tornado.web.HTTPError(404)
 
-        # send to client
-        self.write(json.dumps(report))
-
 
 class Application(tornado.web.Application):
     def __init__(
@@ -58,88 +75,109 @@ class Application(tornado.web.Application):
         *args,
         **kwargs,
     ):
-        # static path
-        static_path = os.path.join(os.path.dirname(__file__), "static_html/")
-
         # init tornado
         tornado.web.Application.__init__(
             self,
             [
                 (r"/", MainHandler),
                 (r"/(.*).json", JsonHandler),
-                (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": static_path}),
+                (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": STATIC_DIR}),
             ],
+            template_path=BASE_DIR,
         )
 
         # init other stuff
         self.current: Report = Report()
-        self.buffer: list[Report] = []
-        self.history: list[Report] = []
+        self._sum = np.zeros(len(COLUMNS))
+        self._n = 0
+        self.history: deque[Report] = deque(maxlen=10)
         self.log_file = log_file
         self.log_current = log_current
         self.log_average = log_average
+        self._log_fp: Optional[TextIO] = None
+        self._log_executor = ThreadPoolExecutor(max_workers=1)
+        self._sinks: tuple[Callable[[Report], None], ...] = ()
 
         # load history
         self._load_history()
+        self._update_history_cache()
+
+        # open log file once, line buffered, so every row gets written with a single syscall
+        if self.log_file is not None:
+            self._log_fp = open(self.log_file, "a", buffering=1)
+            self._log_header_written = self._log_fp.tell() > 0
+            atexit.register(self._log_fp.close)
 
     @property
     def average(self) -> Report:
-        return self.history[0] if len(self.history) > 0 else Report()
+        return self.history[0] if self.history else Report()
+
+    def attach_sinks(self, *sinks: Callable[[Report], None]):
+        """Set functions that are called with every new report."""
+        self._sinks = sinks
 
     def callback(self, report: Report):
         self.current = report
-        self.buffer.append(report)
+
+        # add to running sum for average
+        self._sum += report.arr
+        self._n += 1
+
+        # forward
+        for sink in self._sinks:
+            sink(report)
 
     def _load_history(self):
         """Load history from log file"""
 
         # no logfile?
-        if self.log_file is None or not os.path.exists(self.log_file):
+        if self.log_file is None:
             return
 
-        # open file
-        with open(self.log_file, "r") as csv:
-            # check header
-            if csv.readline() != f"time,{','.join(COLUMNS)}\n":
-                logging.error("Invalid log file format.")
-                return
-
-            # read lines
-            for line in csv:
-                # split and check
-                split = line.split(",")
-                if len(split) != len(COLUMNS) + 1:
+        # open file, large buffer so that it's usually read at once
+        try:
+            with open(self.log_file, "r", newline="", buffering=1 << 20) as f:
+                # check header
+                if f.readline() != HEADER:
                     logging.error("Invalid log file format.")
-                    continue
+                    return
 
-                # read line
-                values = {c: float(s) for c, s in zip(COLUMNS, split[1:])}
-                time = datetime.datetime.strptime(split[0], "%Y-%m-%dT%H:%M:%S")
-                self.history.append(Report(values, time))
+                # only the last lines end up in history, so skip all others without parsing them
+                rows = deque(csv.reader(f), maxlen=self.history.maxlen)
+        except FileNotFoundError:
+            return
 
-        # crop
-        self._crop_history()
+        # parse lines
+        for row in rows:
+            # check
+            if len(row) != len(COLUMNS) + 1:
+                logging.error("Invalid log file format.")
+                continue
 
-    def _crop_history(self):
-        # sort history
-        self.history = sorted(self.history, key=lambda h: h.time, reverse=True)
+            # read line, file is in chronological order, so newest ends up first
+            self.history.appendleft(Report(np.array(row[1:], dtype=np.float64), _parse_time(row[0])))
 
-        # crop to 10 entries
-        if len(self.history) > 10:
-            self.history = self.history[:10]
+    def _update_history_cache(self):
+        """History only changes in sched_callback, so prepare its output for web requests here."""
+        self.average_json = _report_json(self.average)
+        self.average_etag = f'"{hashlib.sha1(self.average_json).hexdigest()}"'
+        self.history_rows = [
+            [h.time.strftime("%Y-%m-%dT%H:%M:%S"), *[f"{v:.2f}" for v in h.arr.tolist()]] for h in self.history
+        ]
 
     def sched_callback(self):
         # check
-        if len(self.buffer) == 0:
+        if self._n == 0:
             return
 
         # average reports
-        average = {k: np.mean([b.values[k] for b in self.buffer]) for k in COLUMNS}
-        dt = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        average = self._sum / self._n
+        now = datetime.datetime.now(datetime.timezone.utc)
+        dt = f"{now:%Y-%m-%dT%H:%M:%S}"
 
-        # add to history
-        self.history.append(Report(average))
-        self._crop_history()
+        # add to history, newest first
+        self.history.appendleft(Report(average, now))
+        self._update_history_cache()
 
         # write to log file?
         if self.log_file is not None:
@@ -148,21 +186,22 @@ class Application(tornado.web.Application):
             except:
                 pass
 
-        # reset reports
-        self.buffer.clear()
+        # reset sum
+        self._sum[:] = 0
+        self._n = 0
 
-    def write_log(self, dt: str, average: dict[str, float]):
-        # does it exist?
-        if not os.path.exists(self.log_file):
-            # write header
-            with open(self.log_file, "w") as csv:
-                csv.write(f"time,{','.join(COLUMNS)}\n")
+    def write_log(self, dt: str, average: np.ndarray):
+        # build line
+        line = ROW_FORMAT.format(dt, *average.tolist())
 
-        # write line
-        with open(self.log_file, "a") as csv:
-            fmt = "{time}," + ",".join(["{" + c + ":.2f}" for c in COLUMNS])
-            csv.write(fmt.format(time=dt, **average))
-            csv.write("\n")
+        # prepend header for new file
+        if not self._log_header_written:
+            line = HEADER + line
+            self._log_header_written = True
+
+        # write it at once in a single worker thread, which keeps the order and
+        # doesn't block the IOLoop if the log file is on a slow file system
+        tornado.ioloop.IOLoop.current().run_in_executor(self._log_executor, self._log_fp.write, line)
 
 
 def main():
@@ -191,40 +230,42 @@ def main():
     # init app
     application = Application(**vars(args))
 
+    # everything except polling runs on the IOLoop
+    ioloop = tornado.ioloop.IOLoop.current()
+
     # influx
     p = [] if args.influx is None else args.influx
     influx = Influx(*p)
-    influx.start()
-
-    # callback method
-    def callback(report: Report):
-        # forward to application and influx
-        application.callback(report)
-        influx(report)
+    ioloop.add_callback(influx.start)
 
-    # start polling
-    sqm.start_polling(callback)
+    # start polling, new reports are handed to application on IOLoop, which forwards them to influx
+    application.attach_sinks(influx)
+    sqm.start_polling(functools.partial(ioloop.add_callback, application.callback))
 
     # init tornado web server
-    http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(args.http_port)
+    application.listen(args.http_port)
+
+    # scheduler on IOLoop, every 5 minutes
+    sched = tornado.ioloop.PeriodicCallback(application.sched_callback, 5 * 60 * 1000)
+
+    def start_sched():
+        application.sched_callback()
+        sched.start()
 
-    # scheduler
-    sched = BackgroundScheduler()
-    trigger = CronTrigger(minute="*/5")
-    sched.add_job(application.sched_callback, trigger)
-    sched.start()
+    # align first call to next full 5 minutes
+    delay = 5 * 60 - datetime.datetime.now().timestamp() % (5 * 60)
+    ioloop.call_later(delay, start_sched)
 
     # start loop
     try:
-        tornado.ioloop.IOLoop.current().start()
+        ioloop.start()
     except KeyboardInterrupt:
         pass
 
     # stop polling
-    influx.stop()
+    ioloop.run_sync(influx.stop)
     sqm.stop_polling()
-    sched.shutdown()
+    sched.stop()
 
 
 if __name__ == "__main__":